@@ -1,14 +1,17 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import contextlib
+import fnmatch
+import functools
 import glob
 import logging
-import multiprocessing
 import os
 from os.path import join as j
 from pathlib import Path
 import platform
+import re
 import shlex
 import shutil
 import signal  # noqa: F401
@@ -22,10 +25,14 @@ from installfedoraonzfs.breakingbefore import BreakingBefore, break_stages, shel
 from installfedoraonzfs.cmd import (
     Popen,
     bindmount,
+    blkid,
     check_call,
+    check_call_input,
     check_call_silent,
     check_call_silent_stdout,
     check_output,
+    copy_file,
+    cpu_count,
     create_file,
     delete_contents,
     filetype,
@@ -35,7 +42,7 @@ from installfedoraonzfs.cmd import (
     losetup,
     mount,
     readlines,
-    readtext,
+    udev_settle,
     umount,
     writetext,
 )
@@ -403,6 +410,9 @@ import_pool_retryable = retrymod.retry(
 )(import_pool)  # type: ignore
 
 
+_LINUX_FS_GUID = "0FC63DAF-8483-4772-8E79-3D69E47DE4E4"
+
+
 def partition_boot(bootdev: Path, bootsize: int, rootvol: bool) -> None:
     """Partitions device into four partitions.
 
@@ -413,87 +423,56 @@ def partition_boot(bootdev: Path, bootsize: int, rootvol: bool) -> None:
 
     Caller is responsible for waiting until the devices appear.
     """
-    cmd = ["gdisk", str(bootdev)]
-    pr = Popen(cmd, stdin=subprocess.PIPE)
+    half = int(bootsize / 2)
+    script = [
+        "label: gpt",
+        "size=2MiB, type=21686148-6449-6E6F-744E-656564454649",
+        f"size={half}MiB, type=C12A7328-F81F-11D2-BA4B-00A0C93EC93B",
+    ]
     if rootvol:
         _LOGGER.info(
             "Creating 2M BIOS boot, %sM EFI system, %sM boot, rest root partition",
-            int(bootsize / 2),
-            int(bootsize / 2),
-        )
-        pr.communicate(
-            f"""o
-y
-
-n
-1
-
-+2M
-21686148-6449-6E6F-744E-656564454649
-
-
-n
-2
-
-+{int(bootsize / 2)}M
-C12A7328-F81F-11D2-BA4B-00A0C93EC93B
-
-
-n
-3
-
-+{int(bootsize / 2)}M
-
-
-
-n
-4
-
-
-
-
-
-p
-w
-y
-"""
+            half,
+            half,
         )
+        script.append(f"size={half}MiB, type={_LINUX_FS_GUID}")
     else:
         _LOGGER.info(
             "Creating 2M BIOS boot, %sM EFI system, the rest boot partition",
-            int(bootsize / 2),
+            half,
         )
-        pr.communicate(
-            f"""o
-y
-
-n
-1
-
-+2M
-21686148-6449-6E6F-744E-656564454649
-
+    script.append(f"type={_LINUX_FS_GUID}")
+    _LOGGER.debug("sfdisk script for %s: %r", bootdev, script)
+    cmd = ["sfdisk", "--wipe", "always", str(bootdev)]
+    check_call_input(cmd, "\n".join(script) + "\n")
 
-n
-2
 
-+{int(bootsize / 2)}M
-C12A7328-F81F-11D2-BA4B-00A0C93EC93B
+_PART_SUFFIXES = ("-part%d", "p%d", "%d")
+# The suffix style that last matched for each device.  It only decides which
+# style is tried first; the partition it names must still exist.
+_part_suffix_cache: dict[str, str] = {}
 
 
-n
-3
+def resolve_part(dev: Path, n: int) -> Path | None:
+    """Return the device node of partition n of dev, or None if absent.
 
-
-
-p
-w
-y
-"""
-        )
-    retcode = pr.wait()
-    if retcode != 0:
-        raise subprocess.CalledProcessError(retcode, cmd)
+    Symlinks such as udev's by-id names count only if they resolve, so a
+    link left dangling by a removed partition is not mistaken for it.
+    """
+    devstr = str(dev)
+    suffixes: tuple[str, ...] = (
+        ("p%d",) if devstr.startswith("/dev/loop") else _PART_SUFFIXES
+    )
+    cached = _part_suffix_cache.pop(devstr, None)
+    if cached:
+        suffixes = (cached,) + tuple(s for s in suffixes if s != cached)
+    for suffix in suffixes:
+        part = Path(devstr + suffix % n)
+        if not os.path.exists(part):
+            continue
+        _part_suffix_cache[devstr] = suffix
+        return part
+    return None
 
 
 @contextlib.contextmanager
@@ -520,53 +499,31 @@ def blockdev_context(
         _LOGGER.info("Entering blockdev context.  Create=%s.", create)
 
         def get_rootpart(rdev: Path) -> Path | None:
-            parts = (
-                [str(rdev) + "p4"]
-                if str(rdev).startswith("/dev/loop")
-                else [
-                    str(rdev) + "-part4",
-                    str(rdev) + "4",
-                ]
-            )
-            for rootpart in parts:
-                if os.path.exists(rootpart):
-                    return Path(rootpart)
-            return None
+            return resolve_part(rdev, 4)
 
         def get_efipart_bootpart(bdev: Path) -> tuple[Path, Path] | tuple[None, None]:
-            parts = (
-                [
-                    (str(bdev) + "p2", str(bdev) + "p3"),
-                ]
-                if str(bdev).startswith("/dev/loop")
-                else [
-                    (str(bdev) + "-part2", str(bdev) + "-part3"),
-                    (str(bdev) + "2", str(bdev) + "3"),
-                ]
-            )
-            for efipart, bootpart in parts:
-                _LOGGER.info(
-                    "About to check for the existence of %s and %s.", efipart, bootpart
-                )
-                if os.path.exists(efipart) and os.path.exists(bootpart):
-                    _LOGGER.info("Both %s and %s exist.", efipart, bootpart)
-                    return Path(efipart), Path(bootpart)
+            _LOGGER.info("About to check for partitions 2 and 3 of %s.", bdev)
+            efipart, bootpart = resolve_part(bdev, 2), resolve_part(bdev, 3)
+            if efipart and bootpart:
+                _LOGGER.info("Both %s and %s exist.", efipart, bootpart)
+                return efipart, bootpart
             return None, None
 
         voltype = filetype(voldev)
+        volcreated = False
 
-        if (
-            voltype == "doesntexist"
-        ):  # FIXME use truncate directly with python.  no need to dick around.
+        if voltype == "doesntexist":
             if not create:
                 raise Exception(
                     f"Wanted to create boot device {voldev} but create=False"
                 )
             create_file(voldev, volsize, owner=chown, group=chgrp)
             voltype = "file"
+            volcreated = True
 
         if voltype == "file":
-            new_voldev = get_associated_lodev(voldev)
+            # A file just created cannot be attached to a loop device yet.
+            new_voldev = None if volcreated else get_associated_lodev(voldev)
             if not new_voldev:
                 new_voldev = losetup(voldev)
 
@@ -577,6 +534,7 @@ def blockdev_context(
 
         if bootdev:
             boottype = filetype(bootdev)
+            bootcreated = False
 
             if boottype == "doesntexist":
                 if not create:
@@ -585,9 +543,10 @@ def blockdev_context(
                     )
                 create_file(bootdev, bootsize * 1024 * 1024, owner=chown, group=chgrp)
                 boottype = "file"
+                bootcreated = True
 
             if boottype == "file":
-                new_bootdev = get_associated_lodev(bootdev)
+                new_bootdev = None if bootcreated else get_associated_lodev(bootdev)
                 if not new_bootdev:
                     new_bootdev = losetup(bootdev)
 
@@ -600,7 +559,7 @@ def blockdev_context(
             efipart, bootpart = get_efipart_bootpart(bootdev if bootdev else voldev)
             if None in (bootpart, efipart):
                 if i > 0:
-                    time.sleep(2)
+                    udev_settle()
                     continue
                 if create:
                     partition_boot(bootdev or voldev, bootsize, not bootdev)
@@ -615,7 +574,7 @@ def blockdev_context(
             efipart, bootpart = get_efipart_bootpart(bootdev if bootdev else voldev)
             if None in (efipart, bootpart):
                 if i > 0:
-                    time.sleep(2)
+                    udev_settle()
                     continue
                 raise Exception(
                     f"partitions 2 or 3 in device"
@@ -649,15 +608,15 @@ def setup_boot_filesystems(
     This function is a noop if file systems already exist.
     """
     try:
-        output = check_output(["blkid", "-c", "/dev/null", str(bootpart)])
+        bootinfo = blkid(bootpart)
     except subprocess.CalledProcessError:
-        output = ""
+        bootinfo = {}
 
-    if 'TYPE="ext4"' not in output:
+    if bootinfo.get("TYPE") != "ext4":
         if not create:
             raise Exception(
                 f"Wanted to create boot file system on {bootpart}"
-                f" but create=False (output: {output})"
+                f" but create=False (blkid: {bootinfo})"
             )
         # Conservative set of features so older distributions can be
         # tested when built in in newer distributions.
@@ -672,15 +631,14 @@ def setup_boot_filesystems(
             + ["-O", ext4_opts]
             + ["-L", "boot_" + label_postfix, str(bootpart)]
         )
-    bootpartuuid = check_output(
-        ["blkid", "-c", "/dev/null", str(bootpart), "-o", "value", "-s", "UUID"]
-    ).strip()
+        bootinfo = blkid(bootpart)
+    bootpartuuid = bootinfo.get("UUID", "")
 
     try:
-        output = check_output(["blkid", "-c", "/dev/null", str(efipart)])
+        efiinfo = blkid(efipart)
     except subprocess.CalledProcessError:
-        output = ""
-    if 'TYPE="vfat"' not in output:
+        efiinfo = {}
+    if efiinfo.get("TYPE") != "vfat":
         if not create:
             raise Exception(
                 f"Wanted to create EFI file system on {efipart} but create=False"
@@ -688,9 +646,8 @@ def setup_boot_filesystems(
         check_call(
             ["mkfs.vfat", "-F", "32", "-n", "efi_" + label_postfix[:7], str(efipart)]
         )
-    efipartuuid = check_output(
-        ["blkid", "-c", "/dev/null", str(efipart), "-o", "value", "-s", "UUID"]
-    ).strip()
+        efiinfo = blkid(efipart)
+    efipartuuid = efiinfo.get("UUID", "")
 
     return bootpartuuid, efipartuuid
 
@@ -731,9 +688,7 @@ def filesystem_context(
         _LOGGER.info("Setting up LUKS.")
         needsdoing = False
         try:
-            rootuuid = check_output(
-                ["blkid", "-c", "/dev/null", str(rootpart), "-o", "value", "-s", "UUID"]
-            ).strip()
+            rootuuid = blkid(rootpart).get("UUID", "")
             if not rootuuid:
                 raise IndexError("no UUID for %s" % rootpart)
             luksuuid = "luks-" + rootuuid
@@ -754,24 +709,14 @@ def filesystem_context(
                 + luksopts
                 + [str(rootpart), "-"]
             )
-            proc = Popen(cmd, stdin=subprocess.PIPE)
-            proc.communicate(lukspassword)
-            retcode = proc.wait()
-            if retcode != 0:
-                raise subprocess.CalledProcessError(retcode, cmd)
-            rootuuid = check_output(
-                ["blkid", "-c", "/dev/null", str(rootpart), "-o", "value", "-s", "UUID"]
-            ).strip()
+            check_call_input(cmd, lukspassword)
+            rootuuid = blkid(rootpart).get("UUID", "")
             if not rootuuid:
                 raise IndexError("still no UUID for %s" % rootpart)
             luksuuid = "luks-" + rootuuid
         if not os.path.exists(j("/dev", "mapper", luksuuid)):
             cmd = ["cryptsetup", "-y", "-v", "luksOpen", str(rootpart), luksuuid]
-            proc = Popen(cmd, stdin=subprocess.PIPE)
-            proc.communicate(lukspassword)
-            retcode = proc.wait()
-            if retcode != 0:
-                raise subprocess.CalledProcessError(retcode, cmd)
+            check_call_input(cmd, lukspassword)
         undoer.to_luks_close.append(luksuuid)
         rootpart = Path(j("/dev", "mapper", luksuuid))
     else:
@@ -815,42 +760,34 @@ def filesystem_context(
     undoer.to_export.append(poolname)
 
     _LOGGER.info("Checking / creating datasets." if create else "Checking datasets")
-    try:
-        check_call_silent_stdout(
-            ["zfs", "list", "-H", "-o", "name", j(poolname, "ROOT")],
-        )
-    except subprocess.CalledProcessError as exc:
+    datasets = set(
+        check_output(["zfs", "list", "-H", "-o", "name", "-r", poolname]).splitlines()
+    )
+    if j(poolname, "ROOT") not in datasets:
         if not create:
             raise Exception(
                 f"Wanted to create ZFS file system ROOT on {poolname} but create=False"
-            ) from exc
+            )
         check_call(["zfs", "create", j(poolname, "ROOT")])
 
-    try:
-        check_call_silent_stdout(
-            ["zfs", "list", "-H", "-o", "name", j(poolname, "ROOT", "os")],
-        )
+    if j(poolname, "ROOT", "os") in datasets:
         if not os.path.ismount(rootmountpoint):
             check_call(["zfs", "mount", j(poolname, "ROOT", "os")])
-    except subprocess.CalledProcessError as exc:
+    else:
         if not create:
             raise Exception(
                 f"Wanted to create ZFS file system ROOT/os on {poolname}"
                 " but create=False"
-            ) from exc
+            )
         check_call(["zfs", "create", "-o", "mountpoint=/", j(poolname, "ROOT", "os")])
     undoer.to_unmount.append(rootmountpoint)
 
     _LOGGER.info("Checking / creating swap zvol." if create else "Checking swap zvol.")
-    try:
-        check_call_silent_stdout(
-            ["zfs", "list", "-H", "-o", "name", j(poolname, "swap")],
-        )
-    except subprocess.CalledProcessError as exc:
+    if j(poolname, "swap") not in datasets:
         if not create:
             raise Exception(
                 f"Wanted to create ZFS file system swap on {poolname} but create=False"
-            ) from exc
+            )
         check_call(
             ["zfs", "create", "-V", "%dM" % swapsize, "-b", "4K", j(poolname, "swap")]
         )
@@ -870,10 +807,10 @@ def filesystem_context(
 
     _LOGGER.info("Checking / formatting swap." if create else "Checking swap.")
     try:
-        output = check_output(["blkid", "-c", "/dev/null", swappart])
+        swaptype = blkid(swappart).get("TYPE")
     except subprocess.CalledProcessError:
-        output = ""
-    if 'TYPE="swap"' not in output:
+        swaptype = None
+    if swaptype != "swap":
         if not create:
             raise Exception(
                 f"Wanted to create swap volume on {poolname}/swap but create=False"
@@ -888,25 +825,25 @@ def filesystem_context(
 
     _LOGGER.info("Mounting virtual and physical file systems.")
     # mount virtual file systems, creating their mount points as necessary
-    for m in "boot sys proc".split():
-        if not os.path.isdir(p(m)):
-            os.mkdir(p(m))
+    bootdir, efidir, sysdir, procdir = map(p, ("boot", "boot/efi", "sys", "proc"))
+    for m in (bootdir, sysdir, procdir):
+        if not os.path.isdir(m):
+            os.mkdir(m)
 
-    if not os.path.ismount(p("boot")):
-        mount(bootpart, Path(p("boot")))
-    undoer.to_unmount.append(p("boot"))
+    if not os.path.ismount(bootdir):
+        mount(bootpart, Path(bootdir))
+    undoer.to_unmount.append(bootdir)
 
-    for m in "boot/efi".split():
-        if not os.path.isdir(p(m)):
-            os.mkdir(p(m))
+    if not os.path.isdir(efidir):
+        os.mkdir(efidir)
 
-    if not os.path.ismount(p("boot/efi")):
-        mount(efipart, Path(p("boot/efi")))
-    undoer.to_unmount.append(p("boot/efi"))
+    if not os.path.ismount(efidir):
+        mount(efipart, Path(efidir))
+    undoer.to_unmount.append(efidir)
 
     for srcmount, bindmounted in [
-        ("/proc", p("proc")),
-        ("/sys", p("sys")),
+        ("/proc", procdir),
+        ("/sys", sysdir),
         # ("/sys/fs/selinux", p("sys/fs/selinux")),
     ]:
         if not os.path.ismount(bindmounted) and os.path.ismount(srcmount):
@@ -939,6 +876,32 @@ def filesystem_context(
         undoer.undo()
 
 
+def initrd_has_zfs_ko(initrd: Path, log_zfs_lines: bool = False) -> bool:
+    """Tell whether the initial RAM disk contains the ZFS kernel module.
+
+    The lsinitrd listing is streamed rather than collected.  Unless every
+    ZFS-related line is to be logged, reading stops at the first match.
+    """
+    cmd = ["lsinitrd", str(initrd)]
+    found = stopped = False
+    with Popen(cmd, stdout=subprocess.PIPE) as proc:
+        assert proc.stdout
+        for line in proc.stdout:
+            if "zfs" not in line:
+                continue
+            if log_zfs_lines:
+                _LOGGER.debug("initramfs: %s", line.rstrip("\n"))
+            if "zfs.ko" in line:
+                found = True
+                if not log_zfs_lines:
+                    proc.terminate()
+                    stopped = True
+                    break
+    if not stopped and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    return found
+
+
 class ZFSMalfunction(Exception):
     """ZFS has malfunctioned."""
 
@@ -956,7 +919,11 @@ class Undoer:
 
     def __init__(self) -> None:
         """Initialize an empty undoer."""
-        self.actions: list[Any] = []
+        # Removed actions are left as None tombstones, and _index maps each
+        # (type, object) pair to its positions in the stack, so that removal
+        # does not need to scan the stack.
+        self.actions: list[tuple[str, Any] | None] = []
+        self._index: dict[tuple[str, Any], list[int]] = {}
 
         class Tracker:
             def __init__(self, typ: str) -> None:
@@ -964,13 +931,13 @@ class Undoer:
 
             def append(me: "Tracker", o: Any) -> None:  # noqa:N805
                 assert o is not None
-                self.actions.append([me.typ, o])
+                self._index.setdefault((me.typ, o), []).append(len(self.actions))
+                self.actions.append((me.typ, o))
 
             def remove(me: "Tracker", o: Any) -> None:  # noqa:N805
-                for n, (typ, origo) in reversed(list(enumerate(self.actions[:]))):
-                    if typ == me.typ and o == origo:
-                        self.actions.pop(n)
-                        break
+                positions = self._index.get((me.typ, o))
+                if positions:
+                    self.actions[positions.pop()] = None
 
         self.to_un_losetup = Tracker("un_losetup")
         self.to_luks_close = Tracker("luks_close")
@@ -991,37 +958,46 @@ class Undoer:
         """Execute the undo action list LIFO style."""
         logger = logging.getLogger("Undoer")
         logger.info("Rewinding stack of actions.")
-        for n, (typ, o) in reversed(list(enumerate(self.actions[:]))):
-            if typ == "unmount":
-                umount(o)
-            if typ == "rmrf":
-                shutil.rmtree(o)
-            if typ == "rmdir":
-                os.rmdir(o)
-            if typ == "export":
-                # check_call(["sync"])
-                check_call(["zpool", "export", o])
-            if typ == "luks_close":
-                # check_call(["sync"])
-                check_call(["cryptsetup", "luksClose", str(o)])
-            if typ == "un_losetup":
-                # check_call(["sync"])
-                cmd = ["losetup", "-d", str(o)]
-                env = dict(os.environ)
-                env["LANG"] = "C.UTF-8"
-                env["LC_ALL"] = "C.UTF-8"
-                output, exitcode = get_output_exitcode(cmd, env=env)
-                if exitcode != 0:
-                    if "No such device or address" in output:
-                        logger.warning("Ignorable failure while detaching %s", o)
-                    else:
-                        raise subprocess.CalledProcessError(
-                            exitcode, ["losetup", "-d", str(o)]
-                        )
-                time.sleep(1)
-            self.actions.pop(n)
+        while self.actions:
+            action = self.actions[-1]
+            if action is None:
+                self.actions.pop()
+                continue
+            self._undo_action(*action, logger)
+            self.actions.pop()
+            self._index[action].pop()
         logger.info("Rewind complete.")
 
+    def _undo_action(self, typ: str, o: Any, logger: logging.Logger) -> None:
+        """Execute a single undo action."""
+        if typ == "unmount":
+            umount(o)
+        if typ == "rmrf":
+            shutil.rmtree(o)
+        if typ == "rmdir":
+            os.rmdir(o)
+        if typ == "export":
+            # check_call(["sync"])
+            check_call(["zpool", "export", o])
+        if typ == "luks_close":
+            # check_call(["sync"])
+            check_call(["cryptsetup", "luksClose", str(o)])
+        if typ == "un_losetup":
+            # check_call(["sync"])
+            cmd = ["losetup", "-d", str(o)]
+            env = dict(os.environ)
+            env["LANG"] = "C.UTF-8"
+            env["LC_ALL"] = "C.UTF-8"
+            output, exitcode = get_output_exitcode(cmd, env=env)
+            if exitcode != 0:
+                if "No such device or address" in output:
+                    logger.warning("Ignorable failure while detaching %s", o)
+                else:
+                    raise subprocess.CalledProcessError(
+                        exitcode, ["losetup", "-d", str(o)]
+                    )
+            time.sleep(1)
+
 
 def chroot_shell(
     in_chroot: Callable[[list[str]], list[str]],
@@ -1124,23 +1100,21 @@ def install_fedora(
                 ]
             )
 
-            # make up a nice locale.conf file. neutral. international
-            localeconf = """LANG="en_US.UTF-8"
-"""
-            writetext(Path(p(j("etc", "locale.conf"))), localeconf)
-
-            # make up a nice vconsole.conf file. neutral. international
-            vconsoleconf = """KEYMAP="us"
-"""
-            writetext(Path(p(j("etc", "vconsole.conf"))), vconsoleconf)
-
             # make up a nice fstab file
             fstab = f"""{poolname}/ROOT/os / zfs defaults,x-systemd-device-timeout=0 0 0
 UUID={bootpartuuid} /boot ext4 noatime 0 1
 UUID={efipartuuid} /boot/efi vfat noatime 0 1
 /dev/zvol/{poolname}/swap swap swap discard 0 0
 """
-            writetext(Path(p(j("etc", "fstab"))), fstab)
+            basic_files = {
+                # make up a nice locale.conf file. neutral. international
+                "locale.conf": 'LANG="en_US.UTF-8"\n',
+                # make up a nice vconsole.conf file. neutral. international
+                "vconsole.conf": 'KEYMAP="us"\n',
+                "fstab": fstab,
+            }
+            for name, text in basic_files.items():
+                writetext(p(j("etc", name)), text)
 
             orig_resolv = p(j("etc", "resolv.conf.orig"))
             final_resolv = p(j("etc", "resolv.conf"))
@@ -1153,25 +1127,26 @@ UUID={efipartuuid} /boot/efi vfat noatime 0 1
             if os.path.islink(final_resolv):
                 os.unlink(final_resolv)
             _LOGGER.info("Writing temporary resolv.conf")
-            writetext(Path(final_resolv), readtext(Path(j("/etc", "resolv.conf"))))
-
-            if not os.path.exists(p(j("etc", "hostname"))):
-                writetext(Path(p(j("etc", "hostname"))), hostname)
-            if not os.path.exists(p(j("etc", "hostid"))):
-                with open("/dev/urandom", "rb") as rnd:
-                    randomness = rnd.read(4)
-                    with open(p(j("etc", "hostid")), "wb") as hostidf:
-                        hostidf.write(randomness)
-            with open(p(j("etc", "hostid")), "rb") as hostidfile:
-                hostid = hostidfile.read().hex()
-            hostid = f"{hostid[6:8]}{hostid[4:6]}{hostid[2:4]}{hostid[0:2]}"
+            shutil.copyfile("/etc/resolv.conf", final_resolv)
+
+            hostnamepath, hostidpath = p("etc/hostname"), p("etc/hostid")
+            if not os.path.exists(hostnamepath):
+                writetext(hostnamepath, hostname)
+            try:
+                with open(hostidpath, "rb") as hostidfile:
+                    hostidbytes = hostidfile.read(4)
+            except FileNotFoundError:
+                hostidbytes = os.urandom(4)
+                with open(hostidpath, "wb") as hostidfile:
+                    hostidfile.write(hostidbytes)
+            # /etc/hostid holds the host ID as a little-endian 32-bit integer.
+            hostid = "%08x" % int.from_bytes(hostidbytes, "little")
             _LOGGER.info("Host ID is %s", hostid)
 
             if luksuuid:
                 crypttab = f"""{luksuuid} UUID={rootuuid} none discard
 """
-                writetext(Path(p(j("etc", "crypttab"))), crypttab)
-                os.chmod(p(j("etc", "crypttab")), 0o600)
+                writetext(p(j("etc", "crypttab")), crypttab, mode=0o600)
 
             # install base packages
             pkgmgr = pm.chroot_bootstrapper_factory(
@@ -1181,15 +1156,15 @@ UUID={efipartuuid} /boot/efi vfat noatime 0 1
 
             # omit zfs modules when dracutting
             if not os.path.exists(p("usr/bin/dracut.real")):
-                check_call(in_chroot(["mv", "/usr/bin/dracut", "/usr/bin/dracut.real"]))
+                os.rename(p("usr/bin/dracut"), p("usr/bin/dracut.real"))
                 writetext(
                     p("usr/bin/dracut"),
                     """#!/bin/bash
 
 echo This is a fake dracut.
 """,
+                    mode=0o755,
                 )
-                os.chmod(p("usr/bin/dracut"), 0o755)
 
             if luksuuid:
                 luksstuff = f" rd.luks.uuid={rootuuid} rd.luks.allow-discards"
@@ -1212,14 +1187,15 @@ GRUB_PRELOAD_MODULES='part_msdos ext2'
             writetext(Path(p(j("etc", "default", "grub"))), grubconfig)
 
             # write kernel command line
-            if not os.path.isdir(p(j("etc", "kernel"))):
-                os.mkdir(p(j("etc", "kernel")))
+            kerneldir = p("etc/kernel")
+            if not os.path.isdir(kerneldir):
+                os.mkdir(kerneldir)
             kernelcmd = (
                 f"root=ZFS={poolname}/ROOT/os rd.md=0 rd.lvm=0 rd.dm=0 quiet"
                 + f""" systemd.show_status=true{luksstuff}
 """
             )
-            writetext(p(j("etc", "kernel", "cmdline")), kernelcmd)
+            writetext(j(kerneldir, "cmdline"), kernelcmd)
 
             chroot_shell(in_chroot, shell_before, "install_kernel")
 
@@ -1348,25 +1324,22 @@ GRUB_PRELOAD_MODULES='part_msdos ext2'
             if not yum_cachedir:
                 # OS owns the cache directory.
                 # Release disk space now that installation is done.
-                for pkgm in ("dnf", "yum"):
-                    for directory in ("cache", "lib"):
-                        delete_contents(Path(p(j("var", directory, pkgm))))
+                with concurrent.futures.ThreadPoolExecutor(max_workers=4) as pool:
+                    futures = [
+                        pool.submit(delete_contents, Path(p(j("var", directory, pkgm))))
+                        for pkgm in ("dnf", "yum")
+                        for directory in ("cache", "lib")
+                    ]
+                    for future in futures:
+                        future.result()
 
             if os.path.exists(p("usr/bin/dracut.real")):
-                check_call(in_chroot(["mv", "/usr/bin/dracut.real", "/usr/bin/dracut"]))
+                os.rename(p("usr/bin/dracut.real"), p("usr/bin/dracut"))
             kernel, initrd, hostonly_initrd, kver = get_kernel_initrd_kver(p)
-            if os.path.isfile(initrd):
-                mayhapszfsko = check_output(["lsinitrd", str(initrd)])
-            else:
-                mayhapszfsko = ""
             # At this point, we regenerate the initrd, if it does not have zfs.ko.
-            if "zfs.ko" not in mayhapszfsko:
+            if not os.path.isfile(initrd) or not initrd_has_zfs_ko(initrd):
                 check_call(in_chroot(["dracut", "-Nf", q(str(initrd)), kver]))
-                after_recreation = check_output(["lsinitrd", str(initrd)])
-                for line in after_recreation.splitlines(False):
-                    if "zfs" in line:
-                        _LOGGER.debug("initramfs: %s", line)
-                if "zfs.ko" not in after_recreation:
+                if not initrd_has_zfs_ko(initrd, log_zfs_lines=True):
                     assert 0, (
                         "ZFS kernel module was not found in the initramfs %s --"
                         " perhaps it failed to build." % initrd
@@ -1408,9 +1381,9 @@ GRUB_PRELOAD_MODULES='part_msdos ext2'
     def biiq(
         init: str, hostonly: bool, enforcing: bool, timeout_factor: float = 1.0
     ) -> None:
-        def fish_kernel_initrd() -> (
-            tuple[str | None, str | None, Path, Path, Path, Path]
-        ):
+        def fish_kernel_initrd(
+            kerneltempdir: Path,
+        ) -> tuple[str | None, str | None, Path, Path, Path]:
             with blockdev_context(
                 voldev, bootdev, volsize, bootsize, chown, chgrp, create=False
             ) as (rootpart, bootpart, efipart), filesystem_context(
@@ -1424,38 +1397,34 @@ GRUB_PRELOAD_MODULES='part_msdos ext2'
                 luksoptions,
                 create=False,
             ) as (_, p, _, _, rootuuid, luksuuid, _, _):
-                kerneltempdir = tempfile.mkdtemp(
-                    prefix="install-fedora-on-zfs-bootbits-"
-                )
-                try:
-                    kernel, initrd, hostonly_initrd, _ = get_kernel_initrd_kver(p)
-                    shutil.copy2(kernel, kerneltempdir)
-                    shutil.copy2(initrd, kerneltempdir)
-                    if os.path.isfile(hostonly_initrd):
-                        shutil.copy2(hostonly_initrd, kerneltempdir)
-                except (KeyboardInterrupt, Exception):
-                    shutil.rmtree(kerneltempdir)
-                    raise
+                kernel, initrd, hostonly_initrd, _ = get_kernel_initrd_kver(p)
+                copy_file(kernel, kerneltempdir)
+                copy_file(initrd, kerneltempdir)
+                if os.path.isfile(hostonly_initrd):
+                    copy_file(hostonly_initrd, kerneltempdir)
             return (
                 rootuuid,
                 luksuuid,
-                Path(kerneltempdir),
                 kernel,
                 initrd,
                 hostonly_initrd,
             )
 
         undoer = Undoer()
-        (
-            rootuuid,
-            luksuuid,
-            kerneltempdir,
-            kernel,
-            initrd,
-            hostonly_initrd,
-        ) = fish_kernel_initrd()
-        undoer.to_rmrf.append(kerneltempdir)
         with undoer:
+            # Register the temporary directory for removal the moment it
+            # exists, so that no failure path can leak it.
+            kerneltempdir = Path(
+                tempfile.mkdtemp(prefix="install-fedora-on-zfs-bootbits-")
+            )
+            undoer.to_rmrf.append(kerneltempdir)
+            (
+                rootuuid,
+                luksuuid,
+                kernel,
+                initrd,
+                hostonly_initrd,
+            ) = fish_kernel_initrd(kerneltempdir)
             return boot_image_in_qemu(
                 hostname,
                 init,
@@ -1606,30 +1575,31 @@ exec /sbin/init "$@"
         raise
 
 
-def _test_cmd(cmdname: str, expected_ret: int) -> bool:
+def _test_cmd(cmdname: str, expected_ret: int | None = None) -> bool:
+    """Check that a command is on the PATH.
+
+    If expected_ret is given, also run the command once, and check that it
+    exits with either 0 or expected_ret, to tell a broken tool from a
+    working one.
+    """
+    args = shlex.split(cmdname)
+    if shutil.which(args[0]) is None:
+        return False
+    if expected_ret is None:
+        return True
     try:
-        with open(os.devnull) as devnull_r, open(os.devnull, "w") as devnull_w:
-            subprocess.check_call(
-                shlex.split(cmdname),
-                stdin=devnull_r,
-                stdout=devnull_w,
-                stderr=devnull_w,
-            )
+        check_call_silent(args)
     except subprocess.CalledProcessError as e:
-        if e.returncode == expected_ret:
-            return True
-        return False
-    except FileNotFoundError:
-        return False
+        return e.returncode == expected_ret
     return True
 
 
 def _test_mkfs_ext4() -> bool:
-    return _test_cmd("mkfs.ext4", 1)
+    return _test_cmd("mkfs.ext4")
 
 
 def _test_mkfs_vfat() -> bool:
-    return _test_cmd("mkfs.vfat", 1)
+    return _test_cmd("mkfs.vfat")
 
 
 def _test_zfs() -> bool:
@@ -1637,15 +1607,15 @@ def _test_zfs() -> bool:
 
 
 def _test_rsync() -> bool:
-    return _test_cmd("rsync", 1)
+    return _test_cmd("rsync")
 
 
-def _test_gdisk() -> bool:
-    return _test_cmd("gdisk", 5)
+def _test_sfdisk() -> bool:
+    return _test_cmd("sfdisk")
 
 
 def _test_cryptsetup() -> bool:
-    return _test_cmd("cryptsetup", 1)
+    return _test_cmd("cryptsetup")
 
 
 def _test_mkpasswd() -> bool:
@@ -1653,16 +1623,7 @@ def _test_mkpasswd() -> bool:
 
 
 def _test_dnf() -> bool:
-    try:
-        check_call_silent_stdout(["dnf", "--help"])
-    except subprocess.CalledProcessError as e:
-        if e.returncode != 1:
-            return False
-    except OSError as e:
-        if e.errno == 2:
-            return False
-        raise
-    return True
+    return _test_cmd("dnf")
 
 
 def install_fedora_on_zfs() -> int:
@@ -1703,8 +1664,10 @@ def install_fedora_on_zfs() -> int:
             "error: mkpasswd is not installed properly. Please install mkpasswd."
         )
         return 5
-    if not _test_gdisk():
-        _LOGGER.error("error: gdisk is not installed properly. Please install gdisk.")
+    if not _test_sfdisk():
+        _LOGGER.error(
+            "error: sfdisk is not installed properly. Please install util-linux."
+        )
         return 5
     if not _test_dnf():
         _LOGGER.error("error: DNF is not installed properly.  Please install DNF.")
@@ -1772,6 +1735,34 @@ def install_fedora_on_zfs() -> int:
     return 0
 
 
+def find_rpms(patterns: Sequence[str], directory: Path, exclude: str) -> list[Path]:
+    """Return the files in directory matching any of the glob patterns.
+
+    Files whose names contain exclude are skipped, and so are dotfiles, as
+    glob would.  The directory is read once regardless of the number of
+    patterns; a missing one yields nothing.
+    """
+    regex = re.compile("|".join(fnmatch.translate(pat) for pat in patterns))
+    try:
+        with os.scandir(directory) as entries:
+            return [
+                Path(e.path)
+                for e in entries
+                if not e.name.startswith(".")
+                and regex.match(e.name)
+                and exclude not in e.name
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def _probe_keystone(
+    in_chroot: Callable[[list[str]], list[str]], keystonepkgs: Sequence[str]
+) -> None:
+    """Raise CalledProcessError unless all keystone packages are installed."""
+    check_call_silent(in_chroot(["rpm", "-q"] + list(keystonepkgs)))
+
+
 def deploy_zfs_in_machine(
     p: Callable[[str], str],
     in_chroot: Callable[[list[str]], list[str]],
@@ -1817,15 +1808,16 @@ def deploy_zfs_in_machine(
                 undoer.to_rmdir.append(target_rpms_path)
             if ismount(target_rpms_path):
                 undoer.to_unmount.append(target_rpms_path)
-            prebuilt_rpms_to_install = {
-                os.path.basename(s)
-                for s in (
-                    glob.glob(j(prebuilt_rpms_path, f"*{arch}.rpm"))
-                    + glob.glob(j(prebuilt_rpms_path, "*noarch.rpm"))
-                )
-                if stringtoexclude not in os.path.basename(s)
-                and stringtoexclude2 not in os.path.basename(s)
-            }
+            suffixes = (f"{arch}.rpm", "noarch.rpm")
+            with os.scandir(prebuilt_rpms_path) as entries:
+                prebuilt_rpms_to_install = {
+                    e.name
+                    for e in entries
+                    if e.name.endswith(suffixes)
+                    and not e.name.startswith(".")
+                    and stringtoexclude not in e.name
+                    and stringtoexclude2 not in e.name
+                }
         else:
             target_rpms_path = None
             prebuilt_rpms_to_install = set()
@@ -1859,7 +1851,7 @@ def deploy_zfs_in_machine(
             pkgs = ["kernel-%s" % uname_r, "kernel-devel-%s" % uname_r]
             pkgmgr.ensure_packages_installed(pkgs)
 
-        for project, patterns, keystonepkgs, mindeps, buildcmd in (
+        projects = (
             (
                 "grub-zfs-fixer",
                 ("grub-zfs-fixer-*.noarch.rpm",),
@@ -1910,11 +1902,29 @@ def deploy_zfs_in_machine(
                     "cd /usr/src/zfs && "
                     "./autogen.sh && "
                     "./configure --with-config=user && "
-                    f"make -j{multiprocessing.cpu_count()} rpm-utils && "
-                    f"make -j{multiprocessing.cpu_count()} rpm-dkms"
+                    "make rpm-utils && "
+                    "make rpm-dkms"
                 ),
             ),
-        ):
+        )
+
+        # The keystone package probes are independent queries, so run them
+        # all at once rather than one chroot at a time.  A project the user
+        # wants a shell before is probed after that shell instead, since
+        # whatever is done there may change the answer.
+        with concurrent.futures.ThreadPoolExecutor(len(projects)) as pool:
+            keystone_probes: dict[str, Callable[[], None]] = {
+                project: (
+                    functools.partial(_probe_keystone, in_chroot, keystonepkgs)
+                    if shell_before == f"deploy_{project.replace('-', '_')}"
+                    else pool.submit(_probe_keystone, in_chroot, keystonepkgs).result
+                )
+                for project, _, keystonepkgs, _, _ in projects
+            }
+
+        ncpus = cpu_count()
+        pending_rpms: list[Path] = []
+        for project, patterns, keystonepkgs, mindeps, buildcmd in projects:
             # check for shell
             project_under = f"deploy_{project.replace('-', '_')}"
             chroot_shell(in_chroot, shell_before, project_under)
@@ -1924,23 +1934,12 @@ def deploy_zfs_in_machine(
                     "Checking if keystone packages %s are installed",
                     ", ".join(keystonepkgs),
                 )
-                check_call_silent(
-                    in_chroot(["rpm", "-q"] + list(keystonepkgs)),
-                )
+                keystone_probes[project]()
             except subprocess.CalledProcessError:
                 _LOGGER.info("Packages %s are not installed, building", keystonepkgs)
                 project_dir = Path(p(j("usr", "src", project)))
 
-                def getrpms(pats: Sequence[str], directory: Path) -> list[Path]:
-                    therpms = [
-                        Path(rpmfile)
-                        for pat in pats
-                        for rpmfile in glob.glob(j(directory, pat))
-                        if stringtoexclude not in os.path.basename(rpmfile)
-                    ]
-                    return therpms
-
-                files_to_install = getrpms(patterns, project_dir)
+                files_to_install = find_rpms(patterns, project_dir, stringtoexclude)
                 if not files_to_install:
                     repo = (
                         zfs_repo
@@ -1957,18 +1956,28 @@ def deploy_zfs_in_machine(
                         pkgmgr.ensure_packages_installed(mindeps)
 
                     _LOGGER.info("Building project: %s", project)
+                    # Parallelism is passed via MAKEFLAGS so that sub-makes
+                    # (including those run by rpmbuild) inherit it.  The load
+                    # cap keeps small-memory machines from swapping.
+                    env = dict(os.environ)
+                    env["MAKEFLAGS"] = f"-j{ncpus} -l{ncpus}"
                     cmd = in_chroot(["bash", "-c", buildcmd])
-                    check_call(cmd)
-                    files_to_install = getrpms(patterns, project_dir)
+                    check_call(cmd, env=env)
+                    files_to_install = find_rpms(patterns, project_dir, stringtoexclude)
+
+                pending_rpms.extend(files_to_install)
 
-                _LOGGER.info("Installing built RPMs: %s", files_to_install)
-                pkgmgr.install_local_packages(files_to_install)
+        # One transaction for everything that was built, in project order.
+        if pending_rpms:
+            _LOGGER.info("Installing built RPMs: %s", pending_rpms)
+            pkgmgr.install_local_packages(pending_rpms)
 
         # Check we have a patched grub2-mkconfig.
         _LOGGER.info("Checking if grub2-mkconfig has been patched")
         mkconfig_file = Path(p(j("usr", "sbin", "grub2-mkconfig")))
-        mkconfig_text = readtext(mkconfig_file)
-        if "This program was patched by fix-grub-mkconfig" not in mkconfig_text:
+        with open(mkconfig_file, "rb") as f:
+            mkconfig_data = f.read()
+        if b"This program was patched by fix-grub-mkconfig" not in mkconfig_data:
             raise ZFSBuildFailure(
                 f"expected to find patched {mkconfig_file} but could not find it."
                 "  Perhaps the grub-zfs-fixer RPM was never installed?"
@@ -3,20 +3,36 @@
 import contextlib
 import errno
 import fcntl
-import glob
+import functools
+import grp
+import io
 import logging
 import os
 from pathlib import Path
+import pwd
+import re
 import select
+import selectors
 import shlex
+import shutil
 import signal
 import stat
+import struct
 import subprocess
 import sys
 import tempfile
-import threading
 import time
-from typing import IO, Any, BinaryIO, Literal, Sequence, TextIO, TypeVar, cast
+from typing import (
+    IO,
+    Any,
+    BinaryIO,
+    Callable,
+    Iterator,
+    Literal,
+    Sequence,
+    TypeVar,
+    cast,
+)
 
 logger = logging.getLogger("cmd")
 
@@ -27,13 +43,21 @@ def readtext(fn: Path) -> str:
         return f.read()
 
 
-def writetext(fn: Path, text: str) -> None:
-    """Write text to a file.
+def writetext(fn: Path | str, text: str, mode: int | None = None) -> None:
+    """Write text to a file, optionally setting its permission bits.
 
     The write is not transactional.  Incomplete writes can appear after a crash
     """
-    with open(fn, "w") as f:
-        f.write(text)
+    data = text.encode()
+    fd = os.open(fn, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+    finally:
+        os.close(fd)
 
 
 def readlines(fn: Path) -> list[str]:
@@ -47,7 +71,47 @@ def readlines(fn: Path) -> list[str]:
 
 def format_cmdline(lst: Sequence[str]) -> str:
     """Format a command line for print()."""
-    return " ".join(shlex.quote(x) for x in lst)
+    return " ".join(map(shlex.quote, lst))
+
+
+class _Deferred:
+    """Log argument computed only if the log record is actually formatted.
+
+    Most subprocess calls are logged at debug level, which is usually
+    discarded, so quoting the command line and looking up the working
+    directory up front would be wasted work.
+    """
+
+    def __init__(self, func: Callable[[], Any]) -> None:
+        """Initialize the deferred argument."""
+        self.func = func
+
+    def __str__(self) -> str:
+        """Compute the argument and stringify it."""
+        return str(self.func())
+
+    def __repr__(self) -> str:
+        """Compute the argument and represent it."""
+        return repr(self.func())
+
+
+def _deferred_cmdline(cmd: Sequence[str]) -> _Deferred:
+    return _Deferred(lambda: format_cmdline(cmd))
+
+
+def _deferred_cwd(kwargs: dict[str, Any]) -> _Deferred:
+    cwd = kwargs.get("cwd")
+    return _Deferred(lambda: os.getcwd() if cwd is None else cwd)
+
+
+@functools.cache
+def _devnull() -> int:
+    """Return a descriptor for /dev/null, opened once and shared by all calls.
+
+    It is not inheritable; subprocess duplicates it onto the child's
+    standard streams.
+    """
+    return os.open(os.devnull, os.O_RDWR)
 
 
 def check_call(cmd: list[str], *args: Any, **kwargs: Any) -> None:
@@ -61,24 +125,43 @@ def check_call(cmd: list[str], *args: Any, **kwargs: Any) -> None:
       *args: positional arguments for check_call
       **kwargs: keyword arguments for check_call
     """
-    cwd = kwargs.get("cwd", os.getcwd())
     kwargs["close_fds"] = True
-    kwargs["stdin"] = open(os.devnull)
+    kwargs["stdin"] = _devnull()
     kwargs["universal_newlines"] = True
-    logger.debug("Check calling %s in cwd %r", format_cmdline(cmd), cwd)
+    logger.debug(
+        "Check calling %s in cwd %r", _deferred_cmdline(cmd), _deferred_cwd(kwargs)
+    )
     subprocess.check_call(cmd, *args, **kwargs)
 
 
 def check_call_silent_stdout(cmd: list[str]) -> None:
     """subprocess.check_call with no standard output."""
-    with open(os.devnull, "w") as devnull:
-        check_call(cmd, stdout=devnull)
+    check_call(cmd, stdout=_devnull())
 
 
 def check_call_silent(cmd: list[str]) -> None:
     """subprocess.check_call with no standard output or error."""
-    with open(os.devnull, "w") as devnull:
-        check_call(cmd, stdout=devnull, stderr=devnull)
+    check_call(cmd, stdout=_devnull(), stderr=_devnull())
+
+
+def check_call_input(cmd: list[str], data: str, **kwargs: Any) -> None:
+    """subprocess.check_call with data fed to standard input.
+
+    The command is logged like check_call does, but the data never is,
+    since it may be a secret.
+
+    Arguments:
+      cmd: command and arguments to run
+      data: text to write to the standard input of the command
+      **kwargs: keyword arguments for subprocess.run
+    """
+    kwargs["close_fds"] = True
+    logger.debug(
+        "Check calling %s with input in cwd %r",
+        _deferred_cmdline(cmd),
+        _deferred_cwd(kwargs),
+    )
+    subprocess.run(cmd, input=data, text=True, check=True, **kwargs)
 
 
 def check_output(cmd: list[str], *args: Any, **kwargs: Any) -> str:
@@ -93,10 +176,11 @@ def check_output(cmd: list[str], *args: Any, **kwargs: Any) -> str:
     logall = kwargs.get("logall", False)
     if "logall" in kwargs:
         del kwargs["logall"]
-    cwd = kwargs.get("cwd", os.getcwd())
     kwargs["universal_newlines"] = True
     kwargs["close_fds"] = True
-    logger.debug("Check outputting %s in cwd %r", format_cmdline(cmd), cwd)
+    logger.debug(
+        "Check outputting %s in cwd %r", _deferred_cmdline(cmd), _deferred_cwd(kwargs)
+    )
     output = cast(str, subprocess.check_output(cmd, *args, **kwargs))
     if output:
         if logall:
@@ -110,12 +194,34 @@ def check_output(cmd: list[str], *args: Any, **kwargs: Any) -> str:
 
 
 def get_associated_lodev(path: Path) -> Path | None:
-    """Return loopback devices associated with path."""
-    output = ":".join(
-        check_output(["losetup", "-j", str(path)]).rstrip().split(":")[:-2]
-    )
-    if output:
-        return Path(output)
+    """Return the loopback device associated with path, if any.
+
+    This is only meant to check whether an image is already attached;
+    losetup() itself reports the device it attaches.  The backing files are
+    read from sysfs, falling back to losetup -j where sysfs is absent.
+    """
+    target = os.path.realpath(path)
+    try:
+        blockdevs = os.scandir("/sys/block")
+    except FileNotFoundError:
+        output = ":".join(
+            check_output(["losetup", "-j", str(path)]).rstrip().split(":")[:-2]
+        )
+        if output:
+            return Path(output)
+        return None
+    with blockdevs:
+        for dev in blockdevs:
+            if not dev.name.startswith("loop"):
+                continue
+            try:
+                with open(f"{dev.path}/loop/backing_file") as f:
+                    backing = f.read().rstrip("\n")
+            except OSError:
+                # Not attached to anything.
+                continue
+            if os.path.realpath(backing) == target:
+                return Path("/dev", dev.name)
     return None
 
 
@@ -138,63 +244,108 @@ def filetype(
 
 def losetup(path: Path) -> Path:
     """Set up a local loop device for a file."""
-    dev = check_output(["losetup", "-P", "--find", "--show", str(path)])[:-1]
-    check_output(["blockdev", "--rereadpt", dev])
+    dev = check_output(["losetup", "-P", "--find", "--show", str(path)]).strip()
+    fd = os.open(dev, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    finally:
+        os.close(fd)
     return Path(dev)
 
 
-class Tee(threading.Thread):
-    """Tees output from filesets to filesets.
+def udev_settle(timeout: int = 5) -> None:
+    """Wait until udev has processed the pending device events.
 
-    Each fileset is a tuple with the first (read) file, and second/third write files.
+    Falls back to sleeping for a couple of seconds where udevadm is not
+    available.  Failures are not fatal; callers check for what they need.
+    """
+    try:
+        output, retcode = get_output_exitcode(
+            ["udevadm", "settle", f"--timeout={timeout}"]
+        )
+    except FileNotFoundError:
+        time.sleep(2)
+        return
+    if retcode != 0:
+        logger.warning(
+            "udevadm settle exited with status %s: %s", retcode, output.strip()
+        )
+
+
+def blkid(dev: Path | str) -> dict[str, str]:
+    """Probe dev once with blkid and return its tags (TYPE, UUID...).
+
+    Raises CalledProcessError like blkid does; exit status 2 means no
+    signature was found on the device.
     """
+    output = check_output(["blkid", "-c", "/dev/null", "-o", "export", str(dev)])
+    return dict(line.split("=", 1) for line in output.splitlines() if "=" in line)
 
-    def __init__(self, *filesets: tuple[TextIO, TextIO, TextIO]):
-        """Initialize the tee."""
-        threading.Thread.__init__(self)
-        self.setDaemon(True)
-        self.filesets = filesets
-        self.err: BaseException | None = None
-
-    def run(self) -> None:
-        """Begin copying from readables to writables.
-
-        The copying in the thread will continue until all readables
-        have been closed.  Writables will not be closed by this
-        algorithm.
-        """
-        pollables = {f[0]: f[1:] for f in self.filesets}
-        for inf in list(pollables.keys()):
-            flag = fcntl.fcntl(inf.fileno(), fcntl.F_GETFL)
-            fcntl.fcntl(inf.fileno(), fcntl.F_SETFL, flag | os.O_NONBLOCK)
-        while pollables:
-            readables, _, _ = select.select(list(pollables.keys()), [], [])
-            data = readables[0].read()
-            try:
-                if not data:
+
+def _byte_writer(w: IO[Any]) -> Callable[[bytes], Any]:
+    """Return a function that writes bytes to w, text stream or not."""
+    if isinstance(w, io.TextIOBase):
+        buffer = getattr(w, "buffer", None)
+        if buffer is not None:
+            # Anything already written as text must come out first.
+            w.flush()
+            return cast(Callable[[bytes], Any], buffer.write)
+        return lambda data: w.write(data.decode(errors="replace"))
+    return w.write
+
+
+_TEE_READ_SIZE = 65536
+
+
+def _drain(fd: int, writers: list[Callable[[bytes], Any]]) -> bool:
+    """Copy everything readable right now from fd; return True at EOF."""
+    while True:
+        try:
+            data = os.read(fd, _TEE_READ_SIZE)
+        except BlockingIOError:
+            return False
+        if not data:
+            return True
+        for write in writers:
+            write(data)
+
+
+def tee(*filesets: tuple[IO[bytes], IO[Any], IO[Any]]) -> None:
+    """Copy from readables to writables until all readables are exhausted.
+
+    Each fileset is a tuple with the first (read) file, and second/third write files.
+    Data is moved as bytes; text writables receive it through their underlying
+    binary buffer when they have one.  Readables are closed as they reach EOF;
+    writables are flushed but not closed.  The first error stops the copy and
+    is raised.
+    """
+    err: BaseException | None = None
+    with selectors.DefaultSelector() as sel:
+        for f in filesets:
+            os.set_blocking(f[0].fileno(), False)
+            sel.register(f[0], selectors.EVENT_READ, [_byte_writer(w) for w in f[1:]])
+        while sel.get_map() and not err:
+            # Service every reader that is ready, not just the first.
+            for key, _ in sel.select():
+                inf = cast(IO[bytes], key.fileobj)
+                try:
+                    eof = _drain(key.fd, key.data)
+                except Exception as exc:
+                    eof = True
+                    err = exc
+                if eof:
                     # Other side of file descriptor closed / EOF.
-                    readables[0].close()
-                    # We will not be polling it again
-                    del pollables[readables[0]]
-                    continue
-                for w in pollables[readables[0]]:
-                    w.write(data)
-            except Exception as exc:
-                readables[0].close()
-                del pollables[readables[0]]
-                if not self.err:
-                    self.err = exc
+                    # We will not be polling it again.
+                    sel.unregister(inf)
+                    inf.close()
+                if err:
                     break
-        for f in self.filesets:
-            for w in f[1:]:
-                with contextlib.suppress(ValueError):
-                    w.flush()
-
-    def join(self, timeout: float | None = None) -> None:
-        """Join the thread."""
-        threading.Thread.join(self, timeout)
-        if self.err:
-            raise self.err
+    for f in filesets:
+        for w in f[1:]:
+            with contextlib.suppress(ValueError):
+                w.flush()
+    if err:
+        raise err
 
 
 def get_output_exitcode(cmd: list[str], **kwargs: Any) -> tuple[str, int]:
@@ -204,31 +355,33 @@ def get_output_exitcode(cmd: list[str], **kwargs: Any) -> tuple[str, int]:
 
     stdout and stderr will be mixed in the returned output.
     """
-    cwd = kwargs.get("cwd", os.getcwd())
-    kwargs["universal_newlines"] = True
-    stdin = kwargs.get("stdin")
-    if "stdin" in kwargs:
-        del kwargs["stdin"]
-    stdout = kwargs.get("stdout", sys.stdout)
-    stderr = kwargs.get("stderr", sys.stderr)
+    stdin = kwargs.pop("stdin", None)
+    stdout = kwargs.pop("stdout", sys.stdout)
+    stderr = kwargs.pop("stderr", sys.stderr)
     if stderr == subprocess.STDOUT:
         assert 0, "you cannot specify subprocess.STDOUT on this function"
 
-    f = tempfile.TemporaryFile(mode="w+")
+    # Most commands say little, so keep their output in memory until it grows.
+    f = tempfile.SpooledTemporaryFile(max_size=1 << 20, mode="w+b")
     try:
-        logger.debug("Get output exitcode %s in cwd %r", format_cmdline(cmd), cwd)
+        logger.debug(
+            "Get output exitcode %s in cwd %r",
+            _deferred_cmdline(cmd),
+            _deferred_cwd(kwargs),
+        )
+        # The pipes are read as bytes and only the collected output is
+        # decoded, once, at the end.
         p = subprocess.Popen(
             cmd, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs
         )
-        t = Tee(
-            (cast(TextIO, p.stdout), f, stdout),
-            (cast(TextIO, p.stderr), f, stderr),
+        # The caller waits for the copy anyway, so do it in this thread.
+        tee(
+            (cast(IO[bytes], p.stdout), cast(IO[bytes], f), stdout),
+            (cast(IO[bytes], p.stderr), cast(IO[bytes], f), stderr),
         )
-        t.start()
-        t.join()
         retval = p.wait()
         f.seek(0)
-        output = f.read()
+        output = f.read().decode(errors="replace")
     finally:
         f.close()
     return output, retval
@@ -236,9 +389,8 @@ def get_output_exitcode(cmd: list[str], **kwargs: Any) -> tuple[str, int]:
 
 def Popen(cmd: list[str], *args: Any, **kwargs: Any) -> subprocess.Popen:
     """subprocess.Popen with logging."""
-    cwd = kwargs.get("cwd", os.getcwd())
     kwargs["universal_newlines"] = True
-    logger.debug("Popening %s in cwd %r", format_cmdline(cmd), cwd)
+    logger.debug("Popening %s in cwd %r", _deferred_cmdline(cmd), _deferred_cwd(kwargs))
     return subprocess.Popen(cmd, *args, **kwargs)
 
 
@@ -262,13 +414,59 @@ def bindmount(source: Path, target: Path) -> Path:
     return mount(source, target, "--bind")
 
 
+def copy_file(source: Path, target_dir: Path) -> Path:
+    """Copy a file into a directory, preserving its metadata like shutil.copy2.
+
+    The data is copied in-kernel with copy_file_range(2) where the kernel and
+    file systems support it, falling back to a regular userspace copy otherwise.
+
+    Returns the path to the copied file.
+    """
+    target = Path(target_dir) / os.path.basename(source)
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        try:
+            while size > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), size)
+                if copied == 0:
+                    break
+                size -= copied
+        except OSError as e:
+            if e.errno not in (
+                errno.EXDEV,
+                errno.ENOSYS,
+                errno.EINVAL,
+                errno.EOPNOTSUPP,
+            ):
+                raise
+            logger.debug("Falling back to userspace copy of %s (%s)", source, e)
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+            shutil.copyfileobj(src, dst)
+    shutil.copystat(source, target)
+    return target
+
+
+BLKGETSIZE64 = 0x80081272
+BLKRRPART = 0x125F
+
+
 def get_file_size(filename: Path) -> int:
-    """Get the file size by seeking at end."""
+    """Get the size of a file or block device.
+
+    Regular files are sized with a single stat; block devices, whose
+    st_size is zero, are asked for their size with the BLKGETSIZE64 ioctl.
+    """
+    s = os.stat(filename)
+    if not stat.S_ISBLK(s.st_mode):
+        return s.st_size
     fd = os.open(filename, os.O_RDONLY)
     try:
-        return os.lseek(fd, 0, os.SEEK_END)
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8)
     finally:
         os.close(fd)
+    return cast(int, struct.unpack("Q", buf)[0])
 
 
 Lockable = TypeVar("Lockable", bound="IO[Any]")
@@ -284,21 +482,114 @@ def _unlockf(f: Lockable) -> Lockable:
     return f
 
 
-def isbindmount(target: Path) -> bool:
+_MOUNTS_ESCAPE_RE = re.compile(rb"\\([0-7]{3})")
+
+
+def mpdecode(field: bytes) -> str:
+    """Decode a device or mount point field from /proc/self/mounts.
+
+    The kernel escapes space, tab, newline and backslash as three-digit octal
+    sequences; everything else is the raw file name.
+    """
+    return os.fsdecode(
+        _MOUNTS_ESCAPE_RE.sub(lambda m: bytes([int(m.group(1), 8)]), field)
+    )
+
+
+_MOUNTS_UNSAFE_RE = re.compile(rb"[ \t\n\\]")
+
+
+def _mpencode(path: str) -> bytes:
+    """Encode a path the way the kernel does in /proc/self/mounts."""
+    return _MOUNTS_UNSAFE_RE.sub(lambda m: b"\\%03o" % m.group()[0], os.fsencode(path))
+
+
+Mounts = tuple[tuple[str, str], ...]
+
+
+def _read_mounts() -> Mounts:
+    """Return the (device, mount point) pairs listed in /proc/self/mounts.
+
+    The file is read every time, but only parsed again when it changed.
+    """
+    with open("/proc/self/mounts", "rb") as f:
+        return _parse_mounts(f.read())
+
+
+@functools.lru_cache(maxsize=1)
+def _parse_mounts(raw: bytes) -> Mounts:
+    """Parse the raw contents of /proc/self/mounts."""
+    return tuple(
+        (mpdecode(fields[0]), mpdecode(fields[1]))
+        for fields in map(bytes.split, raw.splitlines())
+        if len(fields) > 1
+    )
+
+
+def mountpoints(mounts: Mounts | None = None) -> set[str]:
+    """Return the set of mount points listed in /proc/self/mounts.
+
+    A mount table previously read by _read_mounts() may be passed in.
+    """
+    return {mp for _, mp in (_read_mounts() if mounts is None else mounts)}
+
+
+def isbindmount(target: Path, mounts: Mounts | None = None) -> bool:
     """Is path a bind mountpoint."""
+    if mounts is not None:
+        return str(target) in mountpoints(mounts)
+    # Without a table at hand, search the raw file for the escaped target as
+    # a space-delimited field instead of splitting and decoding every line.
+    # Only the mount point field can match: the device field starts the
+    # line, and the fields after it never begin with a slash.
     with open("/proc/self/mounts", "rb") as f:
-        mountpoints = [
-            x.split()[1].decode("unicode-escape") for x in f.read().splitlines()
-        ]
-        return str(target) in mountpoints
+        return b" " + _mpencode(str(target)) + b" " in f.read()
 
 
-def ismount(target: Path) -> bool:
+def ismount(target: Path, mounts: Mounts | None = None) -> bool:
     """Is path a mountpoint."""
-    return os.path.ismount(target) or isbindmount(target)
+    return os.path.ismount(target) or isbindmount(target, mounts)
+
+
+def _read_cmdline(pid: str) -> str | None:
+    """Read the command line of a process, or None if it is gone."""
+    try:
+        fd = os.open(f"/proc/{pid}/cmdline", os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        data = os.read(fd, 65536)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    return format_cmdline(os.fsdecode(data).rstrip("\0").split("\0"))
+
+
+def _iter_proc_links() -> Iterator[tuple[str, bytes]]:
+    """Yield (pid, path) for the open file and cwd links of every process.
+
+    Paths are bytes so that link targets can be read and compared without
+    decoding them.  Processes and descriptors that vanish during the walk
+    are skipped.
+    """
+    with os.scandir(b"/proc") as procs:
+        for proc in procs:
+            if not proc.name.isdigit():
+                continue
+            pid = proc.name.decode()
+            try:
+                with os.scandir(proc.path + b"/fd") as fds:
+                    for fd in fds:
+                        yield pid, fd.path
+            except OSError:
+                pass
+            yield pid, proc.path + b"/cwd"
 
 
-def check_for_open_files(prefix: Path) -> dict[str, list[tuple[str, str]]]:  # noqa: C901
+def check_for_open_files(  # noqa: C901
+    prefix: Path, mounts: Mounts | None = None
+) -> dict[str, list[tuple[str, str]]]:
     """Check that there are open files or mounted file systems within the prefix.
 
     Returns a  dictionary where the keys are the files, and the values are lists
@@ -308,44 +599,47 @@ def check_for_open_files(prefix: Path) -> dict[str, list[tuple[str, str]]]:  # n
     """
     MAXWIDTH = 60
     results: dict[str, list[tuple[str, str]]] = {}
-    files = glob.glob("/proc/*/fd/*") + glob.glob("/proc/*/cwd")
-    for f in files:
+    sprefix = str(prefix)
+    sprefix_sep = sprefix + os.path.sep
+    bprefix = os.fsencode(sprefix)
+    bprefix_sep = os.fsencode(sprefix_sep)
+    cmdlines: dict[str, str | None] = {}
+    for pid, f in _iter_proc_links():
         try:
-            d = os.readlink(f)
-        except Exception:
+            target = os.readlink(f)
+        except OSError:
             continue
-        if d.startswith(str(prefix) + os.path.sep) or d == str(prefix):
-            pid = f.split(os.path.sep)[2]
-            if pid == "self":
-                continue
-            c = os.path.join("/", *(f.split(os.path.sep)[1:3] + ["cmdline"]))
-            try:
-                with open(c) as ff:
-                    cmd = format_cmdline(ff.read().split("\0"))
-            except Exception:
-                continue
-            if len(cmd) > MAXWIDTH:
+        if not (target.startswith(bprefix_sep) or target == bprefix):
+            continue
+        d = os.fsdecode(target)
+        if pid not in cmdlines:
+            cmd = _read_cmdline(pid)
+            if cmd is not None and len(cmd) > MAXWIDTH:
                 cmd = cmd[:57] + "..."
-            if d not in results:
-                results[d] = []
-            results[d].append((pid, cmd))
-    with open("/proc/self/mounts", "rb") as mounts:
-        for line in mounts.read().splitlines():
-            fields = line.split()
-            dev = fields[0].decode("unicode-escape")
-            mp = fields[1].decode("unicode-escape")
-            if mp.startswith(str(prefix) + os.path.sep):
-                if mp not in results:
-                    results[mp] = []
-                results[mp].append(("<mount>", dev))
+            cmdlines[pid] = cmd
+        cmd = cmdlines[pid]
+        if cmd is None:
+            continue
+        if d not in results:
+            results[d] = []
+        results[d].append((pid, cmd))
+    for dev, mp in _read_mounts() if mounts is None else mounts:
+        if not mp.startswith(sprefix_sep):
+            continue
+        if mp not in results:
+            results[mp] = []
+        results[mp].append(("<mount>", dev))
     return results
 
 
 def _killpids(pidlist: Sequence[int]) -> None:
+    me = os.getpid()
     for p in pidlist:
-        if int(p) == os.getpid():
+        if p == me:
             continue
-        os.kill(p, signal.SIGKILL)
+        # The process may have exited since the scan.
+        with contextlib.suppress(ProcessLookupError):
+            os.kill(p, signal.SIGKILL)
 
 
 def _printfiles(openfiles: dict[str, list[tuple[str, str]]]) -> Sequence[int]:
@@ -359,31 +653,75 @@ def _printfiles(openfiles: dict[str, list[tuple[str, str]]]) -> Sequence[int]:
     return list(pids)
 
 
+def _wait_for_release(pids: Sequence[int], timeout: float) -> None:
+    """Wait up to timeout seconds for a reason to retry an unmount.
+
+    Returns early when one of pids exits or the mount table changes (for
+    example, because a file system mounted below the mount point went away).
+    """
+    poller = select.poll()
+    fds: list[int] = []
+    try:
+        for pid in pids:
+            try:
+                fd = os.pidfd_open(pid)
+            except ProcessLookupError:
+                # Already gone; retry right away.
+                return
+            except OSError:
+                continue
+            fds.append(fd)
+            poller.register(fd, select.POLLIN)
+        try:
+            fd = os.open("/proc/self/mountinfo", os.O_RDONLY)
+        except OSError:
+            pass
+        else:
+            fds.append(fd)
+            poller.register(fd, select.POLLPRI | select.POLLERR)
+        poller.poll(timeout * 1000)
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
 def umount(mountpoint: Path, tries: int = 5) -> None:
-    """Unmount a file system, trying `tries` times."""
+    """Unmount a file system, retrying up to `tries` + 1 times.
+
+    The first retry happens right after a sync, since that is often all a
+    busy file system needs; it comes on top of the `tries` regular retries.
+    Waits before those double each time, starting at one second, so the
+    total wait (about 31 seconds for the default) is the same as without
+    the extra retry.  Before the last retry, processes keeping files open
+    in the mountpoint are killed.
+    """
 
-    sleep = 1
-    while True:
-        if not ismount(mountpoint):
-            return None
+    sleep = 0
+    for remaining in range(tries + 1, -1, -1):
+        mounts = _read_mounts()
+        if not ismount(mountpoint, mounts):
+            return
         try:
             check_call(["umount", str(mountpoint)])
-            break
+            return
         except subprocess.CalledProcessError:
-            openfiles = check_for_open_files(mountpoint)
+            pids: Sequence[int] = []
+            openfiles = check_for_open_files(mountpoint, mounts)
             if openfiles:
                 logger.warning("There are open files in %r:", mountpoint)
                 pids = _printfiles(openfiles)
-                if tries <= 1 and pids:
+                if remaining <= 1 and pids:
                     logger.warning("Killing processes with open files: %s:", pids)
                     _killpids(pids)
-            if tries <= 0:
+            if remaining <= 0:
                 raise
-            logger.warning("Syncing and sleeping %d seconds", sleep)
-            # check_call(["sync"])
-            time.sleep(sleep)
-            tries -= 1
-            sleep = sleep * 2
+            os.sync()
+            if sleep:
+                logger.warning("Synced, waiting up to %d seconds", sleep)
+                _wait_for_release(pids, sleep)
+            else:
+                logger.warning("Synced, retrying right away")
+            sleep = sleep * 2 or 1
 
 
 def create_file(
@@ -392,30 +730,62 @@ def create_file(
     owner: str | int | None = None,
     group: str | int | None = None,
 ) -> None:
-    """Create a file of a certain size."""
-    with open(filename, "wb") as f:
-        f.seek(sizebytes - 1)
-        f.write(b"\0")
-    if owner is not None:
-        check_call(["chown", str(owner), "--", str(filename)])
-    if group is not None:
-        check_call(["chgrp", str(group), "--", str(filename)])
+    """Create a (sparse) file of a certain size."""
+    uid = -1 if owner is None else _resolve_uid(owner)
+    gid = -1 if group is None else _resolve_gid(group)
+    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, sizebytes)
+        if uid != -1 or gid != -1:
+            os.fchown(fd, uid, gid)
+    finally:
+        os.close(fd)
+
+
+def _resolve_uid(owner: str | int) -> int:
+    """Resolve a user name or numeric ID to a user ID."""
+    if isinstance(owner, int) or owner.isdigit():
+        return int(owner)
+    return pwd.getpwnam(owner).pw_uid
+
+
+def _resolve_gid(group: str | int) -> int:
+    """Resolve a group name or numeric ID to a group ID."""
+    if isinstance(group, int) or group.isdigit():
+        return int(group)
+    return grp.getgrnam(group).gr_gid
 
 
 def delete_contents(directory: Path) -> None:
-    """Remove a directory completely."""
-    if not os.path.exists(directory):
+    """Remove the contents of a directory, leaving the directory in place.
+
+    Removal continues past entries that cannot be deleted; the first error
+    encountered is raised once every entry has been attempted.
+    """
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
         return
-    ps = [str(os.path.join(directory, p)) for p in os.listdir(directory)]
-    if ps:
-        check_call(["rm", "-rf"] + ps)
+    first_error: OSError | None = None
+    with entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+            except OSError as e:
+                logger.warning("Could not remove %s: %s", entry.path, e)
+                if first_error is None:
+                    first_error = e
+    if first_error is not None:
+        raise first_error
 
 
 def makedirs(ds: list[Path]) -> list[Path]:
     """Recursively create list of directories."""
     for subdir in ds:
-        while not os.path.isdir(subdir):
-            os.makedirs(subdir, exist_ok=True)
+        os.makedirs(subdir, exist_ok=True)
     return ds
 
 
@@ -444,9 +814,36 @@ class lockfile:
         logger.debug("Released lock %s", self.path)
 
 
+def cpu_count() -> int:
+    """Return the number of CPUs this process is allowed to run on.
+
+    Unlike multiprocessing.cpu_count(), this respects the CPU affinity mask
+    (e.g. as restricted by cgroups or taskset).
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+@functools.cache
 def cpuinfo() -> str:
-    """Return the CPU info."""
-    return open("/proc/cpuinfo").read()
+    """Return the CPU info.
+
+    The contents do not change during the life of the process, so the
+    file is only read once.
+    """
+    with open("/proc/cpuinfo") as f:
+        return f.read()
+
+
+@functools.cache
+def cpu_flags() -> frozenset[str]:
+    """Return the feature flags of the first CPU listed in the CPU info."""
+    for line in cpuinfo().splitlines():
+        if line.startswith("flags"):
+            return frozenset(line.partition(":")[2].split())
+    return frozenset()
 
 
 class UnsupportedDistribution(Exception):
@@ -458,7 +855,15 @@ class UnsupportedDistributionVersion(Exception):
 
 
 def get_distro_release_info() -> dict[str, str]:
-    """Obtain the distribution's release info as a dictionary."""
+    """Obtain the distribution's release info as a dictionary.
+
+    /etc/os-release is only read once; callers get their own copy.
+    """
+    return dict(_read_distro_release_info())
+
+
+@functools.cache
+def _read_distro_release_info() -> dict[str, str]:
     vars: dict[str, str] = {}
     try:
         with open("/etc/os-release") as f:
@@ -32,31 +32,24 @@ class NetworkedGitter:
     ) -> None:
         """Check out a repository URL to `project_dir`."""
         qbranch = shlex.quote(branch)
+        reset = (
+            f"{{ git reset --hard origin/{qbranch} || git reset --hard {qbranch}; }}"
+        )
+        # All steps run in a single shell to avoid a fork per git command.
         if os.path.isdir(project_dir):
+            steps = [f"cd {shlex.quote(str(project_dir))}"]
             if update:
                 _LOGGER.info("Updating and checking out git repository: %s", repo)
-                check_call("git fetch".split(), cwd=project_dir)
-                check_call(
-                    [
-                        "bash",
-                        "-c",
-                        f"git reset --hard origin/{qbranch}"
-                        f" || git reset --hard {qbranch}",
-                    ],
-                    cwd=project_dir,
-                )
+                steps += ["git fetch", reset]
         else:
             _LOGGER.info("Cloning git repository: %s", repo)
-            check_call(["git", "clone", repo, str(project_dir)])
-            check_call(
-                [
-                    "bash",
-                    "-c",
-                    f"git reset --hard origin/{qbranch} || git reset --hard {qbranch}",
-                ],
-                cwd=project_dir,
-            )
-        check_call(["git", "--no-pager", "show"], cwd=project_dir)
+            steps = [
+                shlex.join(["git", "clone", "--", repo, str(project_dir)]),
+                f"cd {shlex.quote(str(project_dir))}",
+                reset,
+            ]
+        steps.append("git --no-pager show")
+        check_call(["bash", "-c", " && ".join(steps)])
 
 
 class QubesGitter:
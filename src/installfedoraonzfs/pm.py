@@ -1,7 +1,9 @@
 """Package manager utilities."""
 
+import concurrent.futures
 import contextlib
 import errno
+import functools
 import logging
 import os
 from pathlib import Path
@@ -16,12 +18,40 @@ import installfedoraonzfs.retry as retrymod
 
 _LOGGER = logging.getLogger(__name__)
 
+HOST_DNF_CONF = Path("/etc/dnf/dnf.conf")
+
 DNF_DOWNLOAD_THEN_INSTALL: tuple[list[str], list[str]] = (
     ["--downloadonly"],
     [],
 )
 
 
+_MAIN_SECTION_RE = re.compile(r"\[main]")
+_RPM_NOT_INSTALLED_RE = re.compile("^package (.+) is not installed$", flags=re.M)
+
+
+@functools.cache
+def _option_re(optname: str) -> re.Pattern[str]:
+    """Return a compiled pattern matching the setting of a dnf.conf option."""
+    return re.compile(f"^ *{re.escape(optname)} *=.*$", flags=re.M)
+
+
+def _validate_package_files(package_files: list[Path]) -> list[str]:
+    """Return the absolute paths of package files, checking that they exist.
+
+    The checks run concurrently, since the files may live on slow or
+    network-backed storage.
+    """
+    packages = [os.path.abspath(p) for p in package_files]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        for package, exists in zip(packages, pool.map(os.path.isfile, packages)):
+            if not exists:
+                raise FileNotFoundError(
+                    errno.ENOENT, os.strerror(errno.ENOENT), package
+                )
+    return packages
+
+
 def _run_with_retries(cmd: list[str]) -> tuple[str, int]:
     r = retrymod.retry(2)
     return r(lambda: _check_call_detect_retryable_errors(cmd))()  # type: ignore
@@ -103,12 +133,7 @@ class LocalFedoraPackageManager:
     def install_local_packages(self, package_files: list[Path]) -> None:
         """Install a list of local packages on a Fedora system.  Download them first."""
 
-        packages = [os.path.abspath(p) for p in package_files]
-        for package in packages:
-            if not os.path.isfile(package):
-                raise FileNotFoundError(
-                    errno.ENOENT, os.strerror(errno.ENOENT), package
-                )
+        packages = _validate_package_files(package_files)
         return self.ensure_packages_installed(packages)
 
     def ensure_packages_installed(self, package_names: list[str]) -> None:
@@ -137,12 +162,7 @@ class LocalQubesOSPackageManager:
         Installation is two-phase.  First, take all dependencies the package
         files need, and install these.  Then install the packages themselves.
         """
-        packages = [os.path.abspath(p) for p in package_files]
-        for package in packages:
-            if not os.path.isfile(package):
-                raise FileNotFoundError(
-                    errno.ENOENT, os.strerror(errno.ENOENT), package
-                )
+        packages = _validate_package_files(package_files)
 
         deps: set[str] = set()
         cmd = ["rpm", "-q", "--requires"]
@@ -186,6 +206,10 @@ class ChrootFedoraPackageManagerAndBootstrapper:
         self.releasever = releasever
         self._logger = logging.getLogger(f"{__name__}.{{self.__class__.__name__}}")
         self._cachedir = cachedir.absolute() if cachedir else None
+        self._active_method: (
+            Literal["in_chroot"] | Literal["out_of_chroot"] | None
+        ) = None
+        self._active_config: Path | None = None
 
     def bootstrap_packages(self) -> None:
         """Bootstrap the chroot."""
@@ -213,12 +237,13 @@ class ChrootFedoraPackageManagerAndBootstrapper:
             e(["systemd-networkd"])
             return pkgs
 
-        self._logger.info("Installing basic packages into chroot.")
-        packages = get_base_packages()
-        self._ensure_packages_installed(packages, method="out_of_chroot")
-        self._logger.info("Installing more packages within chroot.")
-        chroot_packages = get_in_chroot_packages()
-        self._ensure_packages_installed(chroot_packages, method="out_of_chroot")
+        with self._method("out_of_chroot"):
+            self._logger.info("Installing basic packages into chroot.")
+            packages = get_base_packages()
+            self._ensure_packages_installed(packages, method="out_of_chroot")
+            self._logger.info("Installing more packages within chroot.")
+            chroot_packages = get_in_chroot_packages()
+            self._ensure_packages_installed(chroot_packages, method="out_of_chroot")
 
     def setup_kernel_bootloader(self) -> None:
         """Install the kernel and the bootloader into the chroot."""
@@ -239,32 +264,50 @@ class ChrootFedoraPackageManagerAndBootstrapper:
     def install_local_packages(self, package_files: list[Path]) -> None:
         """Install a list of local packages on a Fedora system.  Download them first."""
 
-        packages = [os.path.abspath(p) for p in package_files]
-        for package in packages:
-            if not os.path.isfile(package):
-                raise FileNotFoundError(
-                    errno.ENOENT, os.strerror(errno.ENOENT), package
-                )
-        return self._ensure_packages_installed(
-            [str(s) for s in packages], method="out_of_chroot"
-        )
+        packages = _validate_package_files(package_files)
+        return self._ensure_packages_installed(packages, method="out_of_chroot")
+
+    def _chroot_relative(self, path: Path | str) -> str:
+        """Return the path as seen from within the chroot."""
+        return str(Path("/") / Path(path).relative_to(self.chroot))
 
     @contextlib.contextmanager
     def _method(
         self, method: Literal["in_chroot"] | Literal["out_of_chroot"]
+    ) -> Generator[Path, None, None]:
+        """Set up the package manager configuration for a method.
+
+        Re-entrant: nested uses reuse the configuration (and, if a cache
+        directory is in use, the locks and cache mount) of the outermost one.
+        """
+        if self._active_method is not None:
+            assert self._active_method == method, (self._active_method, method)
+            assert self._active_config is not None
+            yield self._active_config
+            return
+
+        with self._setup_method(method) as config:
+            self._active_method, self._active_config = method, config
+            try:
+                yield config
+            finally:
+                self._active_method, self._active_config = None, None
+
+    @contextlib.contextmanager
+    def _setup_method(
+        self, method: Literal["in_chroot"] | Literal["out_of_chroot"]
     ) -> Generator[Path, None, None]:
         pkgmgr = "dnf"
         guestver = self.releasever
         if method == "in_chroot":
             dirforconfig = self.chroot
-            sourceconf = (
-                (self.chroot / "/etc/dnf/dnf.conf")
-                if os.path.isfile(self.chroot / "/etc/dnf/dnf.conf")
-                else Path("/etc/dnf/dnf/conf")
-            )
+            # Not cached: the chroot only gains its own dnf.conf once
+            # bootstrapping has installed dnf into it.
+            chrootconf = self.chroot / HOST_DNF_CONF.relative_to("/")
+            sourceconf = chrootconf if chrootconf.is_file() else HOST_DNF_CONF
         else:
             dirforconfig = Path(os.getenv("TMPDIR") or "/tmp")  # noqa: S108
-            sourceconf = Path("/etc/dnf/dnf.conf")
+            sourceconf = HOST_DNF_CONF
 
         parms = {
             "logfile": "/dev/null",
@@ -311,9 +354,11 @@ class ChrootFedoraPackageManagerAndBootstrapper:
                 cachedir_in_chroot = cmdmod.makedirs(
                     [self.chroot / f"tmp-{pkgmgr}-cache"]
                 )[0]
-                parms["cachedir"] = str(cachedir_in_chroot)[len(str(self.chroot)) :]
+                parms["cachedir"] = self._chroot_relative(cachedir_in_chroot)
                 parms["keepcache"] = "true"
-                while cmdmod.ismount(cachedir_in_chroot):
+                # A single probe of the mount table covers both regular and
+                # bind mounts, unlike ismount()'s stat-then-parse fallback.
+                while str(cachedir_in_chroot) in cmdmod.mountpoints():
                     self._logger.debug("Preemptively unmounting %s", cachedir_in_chroot)
                     cmdmod.umount(cachedir_in_chroot)
                 n = None
@@ -371,30 +416,43 @@ skip_if_unavailable=False
         yumconfigtext = cmdmod.readtext(source)
         for optname, optval in list(kwargs.items()):
             if optval is None:
-                yumconfigtext, repls = re.subn(
-                    f"^ *{optname} *=.*$", "", yumconfigtext, flags=re.M
-                )
+                yumconfigtext, repls = _option_re(optname).subn("", yumconfigtext)
             else:
-                yumconfigtext, repls = re.subn(
-                    f"^ *{optname} *=.*$",
-                    f"{optname}={optval}",
-                    yumconfigtext,
-                    flags=re.M,
+                yumconfigtext, repls = _option_re(optname).subn(
+                    f"{optname}={optval}", yumconfigtext
                 )
                 if not repls:
-                    yumconfigtext, repls = re.subn(
-                        "\\[main]", f"[main]\n{optname}={optval}", yumconfigtext
+                    yumconfigtext, repls = _MAIN_SECTION_RE.subn(
+                        f"[main]\n{optname}={optval}", yumconfigtext
                     )
                     assert repls, (
                         "Could not substitute yum.conf main config section"
                         f" with the {optname} stanza.  Text: {yumconfigtext}"
                     )
-        tempyumconfig.write(yumconfigtext.encode("utf-8"))
-        tempyumconfig.write(fedora_repos_template.encode("utf-8"))
+        tempyumconfig.write((yumconfigtext + fedora_repos_template).encode("utf-8"))
         tempyumconfig.flush()
         tempyumconfig.seek(0)
         return tempyumconfig
 
+    def _missing_packages(self, packages: list[str]) -> list[str]:
+        """Return which of the packages are not installed in the chroot.
+
+        All packages are probed with a single rpm invocation.  If rpm cannot
+        run at all (e.g. the chroot is not bootstrapped yet), all packages
+        are deemed missing.
+        """
+        env = dict(os.environ)
+        env["LC_ALL"] = "C"
+        cmd = ["chroot", str(self.chroot), "rpm", "-q"] + packages
+        try:
+            cmdmod.check_output(cmd, stderr=subprocess.DEVNULL, env=env)
+            return []
+        except subprocess.CalledProcessError as e:
+            output = e.output or ""
+        notinstalled = {m.group(1) for m in _RPM_NOT_INSTALLED_RE.finditer(output)}
+        missing = [p for p in packages if p in notinstalled]
+        return missing or packages
+
     def _ensure_packages_installed(
         self,
         packages: list[str],
@@ -406,14 +464,17 @@ skip_if_unavailable=False
         def in_chroot(lst: list[str]) -> list[str]:
             return ["chroot", str(self.chroot)] + lst
 
-        with self._method(method) as config:
-            try:
-                cmdmod.check_call_silent(in_chroot(["rpm", "-q"] + packages))
-                self._logger.info("All required packages are available")
-                return
-            except subprocess.CalledProcessError:
-                pass
+        packages = self._missing_packages(packages)
+        if not packages:
+            self._logger.info("All required packages are available")
+            return
 
+        with self._method(method) as config:
+            configarg = (
+                str(config)
+                if method == "out_of_chroot"
+                else self._chroot_relative(config)
+            )
             for option in DNF_DOWNLOAD_THEN_INSTALL:
                 self._logger.info(
                     "Installing packages %s %s (extra args: %s): %s",
@@ -426,14 +487,7 @@ skip_if_unavailable=False
                     (["dnf"] if method == "out_of_chroot" else in_chroot(["dnf"]))
                     + ["install", "-y", "--disableplugin=*qubes*"]
                     + more_args
-                    + (
-                        [
-                            "-c",
-                            str(config)
-                            if method == "out_of_chroot"
-                            else str(config)[len(str(self.chroot)) :],
-                        ]
-                    )
+                    + ["-c", configarg]
                     + option
                     + (
                         [
@@ -7,11 +7,14 @@ import unittest
 
 import contextlib
 import installfedoraonzfs
+from installfedoraonzfs import cmd
 import os
+from pathlib import Path
 import shutil
 import subprocess
 import tempfile
 import re
+from unittest import mock
 
 
 @contextlib.contextmanager
@@ -117,6 +120,98 @@ class TestSetupFilesystems(unittest.TestCase):
                 assert efiuuid == efiuuid, (efiuuid, efiuuid2)
 
 
+class TestMountTableEscapes(unittest.TestCase):
+    def testDecodePlain(self) -> None:
+        self.assertEqual(cmd.mpdecode(b"/mnt/root"), "/mnt/root")
+
+    def testDecodeEscapes(self) -> None:
+        self.assertEqual(
+            cmd.mpdecode(b"/mnt/a\\040b\\011c\\012d\\134e"),
+            "/mnt/a b\tc\nd\\e",
+        )
+
+    def testEncodeEscapes(self) -> None:
+        self.assertEqual(
+            cmd._mpencode("/mnt/a b\tc\nd\\e"),
+            b"/mnt/a\\040b\\011c\\012d\\134e",
+        )
+
+    def testRoundtrip(self) -> None:
+        for path in ["/", "/mnt/x y", "/a\\040b", "/tab\there", "/\u00e9t\u00e9"]:
+            self.assertEqual(cmd.mpdecode(cmd._mpencode(path)), path)
+
+
+class TestBlkid(unittest.TestCase):
+    def testParsesExportOutput(self) -> None:
+        output = (
+            "DEVNAME=/dev/loop0p2\n"
+            "UUID=1234-ABCD\n"
+            "BLOCK_SIZE=512\n"
+            "TYPE=vfat\n"
+            "PARTUUID=0f0e-01\n"
+        )
+        with mock.patch.object(cmd, "check_output", return_value=output) as co:
+            tags = cmd.blkid("/dev/loop0p2")
+        co.assert_called_once_with(
+            ["blkid", "-c", "/dev/null", "-o", "export", "/dev/loop0p2"]
+        )
+        self.assertEqual(tags["UUID"], "1234-ABCD")
+        self.assertEqual(tags["TYPE"], "vfat")
+        self.assertEqual(tags["DEVNAME"], "/dev/loop0p2")
+
+    def testValueMayContainEquals(self) -> None:
+        with mock.patch.object(cmd, "check_output", return_value="LABEL=a=b\n\n"):
+            self.assertEqual(cmd.blkid("/dev/x"), {"LABEL": "a=b"})
+
+
+class TestFindRpms(unittest.TestCase):
+    def testMatchesPatternsAndExcludes(self) -> None:
+        d = tempfile.mkdtemp()
+        try:
+            for name in [
+                "zfs-2.2.0-1.fc39.x86_64.rpm",
+                "zfs-debuginfo-2.2.0-1.fc39.x86_64.rpm",
+                "zfs-dkms-2.2.0-1.fc39.noarch.rpm",
+                "libzfs5-2.2.0-1.fc39.x86_64.rpm",
+                "zfs-2.2.0-1.fc39.src.rpm",
+                ".zfs-2.2.0-1.fc39.x86_64.rpm",
+                "README",
+            ]:
+                open(os.path.join(d, name), "w").close()
+            found = installfedoraonzfs.find_rpms(
+                ["zfs-[0123456789]*.x86_64.rpm", "*.noarch.rpm", "libzfs?-*"],
+                Path(d),
+                "debuginfo",
+            )
+            self.assertEqual(
+                sorted(p.name for p in found),
+                [
+                    "libzfs5-2.2.0-1.fc39.x86_64.rpm",
+                    "zfs-2.2.0-1.fc39.x86_64.rpm",
+                    "zfs-dkms-2.2.0-1.fc39.noarch.rpm",
+                ],
+            )
+            self.assertTrue(all(p.parent == Path(d) for p in found))
+        finally:
+            shutil.rmtree(d)
+
+    def testSkipsDotfiles(self) -> None:
+        d = tempfile.mkdtemp()
+        try:
+            open(os.path.join(d, ".hidden.noarch.rpm"), "w").close()
+            self.assertEqual(
+                installfedoraonzfs.find_rpms(["*.noarch.rpm"], Path(d), "debuginfo"),
+                [],
+            )
+        finally:
+            shutil.rmtree(d)
+
+    def testMissingDirectory(self) -> None:
+        self.assertEqual(
+            installfedoraonzfs.find_rpms(["*.rpm"], Path("/nonexistent"), "x"), []
+        )
+
+
 if __name__ == "__main__":
     # import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
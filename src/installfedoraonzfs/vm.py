@@ -5,6 +5,7 @@ import logging
 import os
 from pathlib import Path
 import pty
+import shutil
 import subprocess
 import threading
 import time
@@ -13,8 +14,7 @@ import uuid
 
 from installfedoraonzfs.cmd import (
     Popen,
-    check_call_silent,
-    cpuinfo,
+    cpu_flags,
     format_cmdline,
     get_associated_lodev,
 )
@@ -22,6 +22,8 @@ from installfedoraonzfs.retry import Retryable
 
 logger = logging.getLogger("VM")
 qemu_full_emulation_factor = 5
+# Longest unterminated console output kept around for prompt matching.
+max_console_tail = 4096
 
 
 class VMSetupException(Exception):
@@ -68,7 +70,7 @@ def detect_qemu(force_kvm: bool | None = None) -> QemuOpts:
     elif force_kvm is True:
         emucmd = "qemu-kvm"
         emuopts = ["-enable-kvm"]
-    elif "vmx" in cpuinfo() or "svm" in cpuinfo():
+    elif not cpu_flags().isdisjoint(("vmx", "svm")):
         emucmd = "qemu-kvm"
         emuopts = ["-enable-kvm"]
     return emucmd, emuopts
@@ -76,17 +78,7 @@ def detect_qemu(force_kvm: bool | None = None) -> QemuOpts:
 
 def test_qemu() -> bool:
     """Test for the presence of QEMU."""
-    try:
-        check_call_silent([detect_qemu()[0], "--help"])
-    except subprocess.CalledProcessError as e:
-        if e.returncode == 0:
-            return True
-        raise
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            return False
-        raise
-    return True
+    return shutil.which(detect_qemu()[0]) is not None
 
 
 def boot_image_in_qemu(
@@ -284,7 +276,7 @@ class BootDriver(threading.Thread):
         self.login = login
         self.password = password
         self.pty = pty
-        self.output: list[bytes] = []
+        self.output = bytearray()
         self.error: Exception | None = None
 
     def run(self) -> None:
@@ -293,7 +285,7 @@ class BootDriver(threading.Thread):
         consolelogger = logging.getLogger("VM.console")
         if self.luks_passphrase:
             logger.info("Expecting LUKS passphrase prompt")
-        lastline: list[bytes] = []
+        pending = b""
 
         unseen = "unseen"
         waiting_for_escape_sequence = "waiting_for_escape_sequence"
@@ -313,7 +305,7 @@ class BootDriver(threading.Thread):
         try:
             while True:
                 try:
-                    c = self.pty.read(1)
+                    c = self.pty.read(4096)
                 except OSError as e:
                     if e.errno == errno.EIO:
                         c = b""
@@ -322,96 +314,72 @@ class BootDriver(threading.Thread):
                 if c == b"":
                     logger.info("QEMU slave PTY gone")
                     break
-                self.output.append(c)
-                if c == b"\n":
-                    s = b"".join(lastline)
-                    consolelogger.debug(s.decode("utf-8"))
-
-                    if (
-                        b"traps: systemd[1] general protection" in s
-                        or b"memory corruption" in s
-                        or b"Freezing execution." in s
-                    ):
-                        # systemd or udevd exploded.  Raise retryable SystemdSegfault.
-                        self.error = SystemdSegfault(
-                            "systemd appears to have segfaulted."
-                        )
-                    elif b" authentication failure." in s:
-                        self.error = BadPW("authentication failed")
-                    elif b" Not enough available memory to open a keyslot." in s:
-                        # OOM.  Raise non-retryable OOMed.
-                        self.error = OOMed("a process appears to have been OOMed.")
-                    elif b" Killed" in s:
-                        # OOM.  Raise non-retryable OOMed.
-                        self.error = OOMed("a process appears to have been OOMed.")
-                    elif b"end Kernel panic" in s:
-                        # OOM.  Raise non-retryable kernel panic.
-                        self.error = Panicked("kernel has panicked.")
-                    elif b"Kernel panic - not syncing" in s:
-                        # OOM.  Raise non-retryable kernel panic.
-                        self.error = Panicked("kernel has panicked.")
-                    elif b"root password for maintenance" in s:
-                        # System did not boot.
-                        self.error = Emergency("system entered emergency mode")
-
-                    lastline = []
-                elif c == b"\r":
-                    pass
-                else:
-                    lastline.append(c)
-                s = b"".join(lastline)
-
-                if self.luks_passphrase:
-                    if luks_passphrase_prompt_state == unseen:
-                        if b"nter passphrase for" in s:
-                            # Please enter passphrase for disk QEMU...
-                            # Enter passphrase for /dev/...
-                            # LUKS passphrase prompt appeared.  Enter it later.
-                            logger.info("Passphrase prompt begun appearing.")
-                            luks_passphrase_prompt_state = waiting_for_escape_sequence
-                    if luks_passphrase_prompt_state == waiting_for_escape_sequence:
-                        if b"[0m" in s or b")!" in s:
-                            logger.info("Passphrase prompt done appearing.")
-                            luks_passphrase_prompt_state = pending_write
-                    if luks_passphrase_prompt_state == pending_write:
-                        logger.info("Writing passphrase.")
-                        self.write_luks_passphrase()
-                        luks_passphrase_prompt_state = written
-
-                if self.login and self.password:
-                    if login_prompt_state == unseen:
-                        if b" login: " in s:
-                            # Please enter passphrase for disk QEMU...
-                            # Enter passphrase for /dev/...
-                            # LUKS passphrase prompt appeared.  Enter it later.
-                            logger.info("Login prompt begun appearing.")
-                            login_prompt_state = login_prompt_seen
-                    if login_prompt_state == login_prompt_seen:
-                        logger.info("Writing login.")
-                        self.write_login()
-                        login_prompt_state = login_written
-                    if login_prompt_state == login_written:
-                        if b"Password: " in s:
-                            logger.info("Password prompt begun appearing.")
-                            login_prompt_state = password_prompt_seen
-                    if login_prompt_state == password_prompt_seen:
-                        logger.info("Writing password.")
-                        self.write_password()
-                        login_prompt_state = password_written
-                    if login_prompt_state == password_written:
-                        if b" ~]# " in s:
-                            logger.info("Shell prompt begun appearing.")
-                            login_prompt_state = shell_prompt_seen
-                    if login_prompt_state == shell_prompt_seen:
-                        logger.info("Writing poweroff.")
-                        self.write_poweroff()
-                        login_prompt_state = poweroff_written
+                self.output += c
+                *lines, pending = (pending + c).split(b"\n")
+                if len(pending) > max_console_tail:
+                    # Output with no newline in sight must not pile up and be
+                    # split again on every read.  Prompts are short, so only
+                    # the end is kept; the rest is handled as a line.
+                    lines.append(pending[:-max_console_tail])
+                    pending = pending[-max_console_tail:]
+                # Every complete line is checked for errors, then the
+                # unterminated tail is checked too, since prompts do not end
+                # in a newline.
+                for n, line in enumerate(lines + [pending]):
+                    s = line.replace(b"\r", b"")
+                    if n < len(lines):
+                        self._check_line(s, consolelogger)
+
+                    if self.luks_passphrase:
+                        if luks_passphrase_prompt_state == unseen:
+                            if b"nter passphrase for" in s:
+                                # Please enter passphrase for disk QEMU...
+                                # Enter passphrase for /dev/...
+                                # LUKS passphrase prompt appeared.  Enter it later.
+                                logger.info("Passphrase prompt begun appearing.")
+                                luks_passphrase_prompt_state = (
+                                    waiting_for_escape_sequence
+                                )
+                        if luks_passphrase_prompt_state == waiting_for_escape_sequence:
+                            if b"[0m" in s or b")!" in s:
+                                logger.info("Passphrase prompt done appearing.")
+                                luks_passphrase_prompt_state = pending_write
+                        if luks_passphrase_prompt_state == pending_write:
+                            logger.info("Writing passphrase.")
+                            self.write_luks_passphrase()
+                            luks_passphrase_prompt_state = written
+
+                    if self.login and self.password:
+                        if login_prompt_state == unseen:
+                            if b" login: " in s:
+                                logger.info("Login prompt begun appearing.")
+                                login_prompt_state = login_prompt_seen
+                        if login_prompt_state == login_prompt_seen:
+                            logger.info("Writing login.")
+                            self.write_login()
+                            login_prompt_state = login_written
+                        if login_prompt_state == login_written:
+                            if b"Password: " in s:
+                                logger.info("Password prompt begun appearing.")
+                                login_prompt_state = password_prompt_seen
+                        if login_prompt_state == password_prompt_seen:
+                            logger.info("Writing password.")
+                            self.write_password()
+                            login_prompt_state = password_written
+                        if login_prompt_state == password_written:
+                            if b" ~]# " in s:
+                                logger.info("Shell prompt begun appearing.")
+                                login_prompt_state = shell_prompt_seen
+                        if login_prompt_state == shell_prompt_seen:
+                            logger.info("Writing poweroff.")
+                            self.write_poweroff()
+                            login_prompt_state = poweroff_written
 
             logger.info("Boot driver ended")
             if not self.error:
                 if (
-                    b"reboot: Power down" not in self.get_output()
-                    and b"reboot: Restarting system" not in self.get_output()
+                    b"reboot: Power down" not in self.output
+                    and b"reboot: Restarting system" not in self.output
                 ):
                     self.error = MachineNeverShutoff(
                         "The bootable image never shut off."
@@ -420,9 +388,38 @@ class BootDriver(threading.Thread):
         except Exception as exc:
             self.error = exc
 
+    def _check_line(self, s: bytes, consolelogger: logging.Logger) -> None:
+        """Log a complete console line and detect boot failures in it."""
+        consolelogger.debug(s.decode("utf-8", "replace"))
+
+        if (
+            b"traps: systemd[1] general protection" in s
+            or b"memory corruption" in s
+            or b"Freezing execution." in s
+        ):
+            # systemd or udevd exploded.  Raise retryable SystemdSegfault.
+            self.error = SystemdSegfault("systemd appears to have segfaulted.")
+        elif b" authentication failure." in s:
+            self.error = BadPW("authentication failed")
+        elif b" Not enough available memory to open a keyslot." in s:
+            # OOM.  Raise non-retryable OOMed.
+            self.error = OOMed("a process appears to have been OOMed.")
+        elif b" Killed" in s:
+            # OOM.  Raise non-retryable OOMed.
+            self.error = OOMed("a process appears to have been OOMed.")
+        elif b"end Kernel panic" in s:
+            # OOM.  Raise non-retryable kernel panic.
+            self.error = Panicked("kernel has panicked.")
+        elif b"Kernel panic - not syncing" in s:
+            # OOM.  Raise non-retryable kernel panic.
+            self.error = Panicked("kernel has panicked.")
+        elif b"root password for maintenance" in s:
+            # System did not boot.
+            self.error = Emergency("system entered emergency mode")
+
     def get_output(self) -> bytes:
         """Get the total sum of output from the Linux console."""
-        return b"".join(self.output)
+        return bytes(self.output)
 
     def join(self, timeout: float | None = None) -> None:
         """Join the VM execuion thread."""